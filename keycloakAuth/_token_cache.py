@@ -0,0 +1,149 @@
+"""
+Two-tier cache of verified access token claims.
+
+Tokens are keyed by a short blake2b digest of the raw token string and kept
+until their ``exp`` (capped by ``AUTH_CACHE_TTL_CAP``). The first tier lives
+in-process; a token is only admitted into it the second time it is seen, so
+one-shot tokens (batch jobs, scanners) can't evict the claims of active user
+sessions. When ``AUTH_CACHE_REDIS_URL`` is set, claims and revocations are
+also shared through Redis so every worker and pod benefits from them.
+"""
+import hashlib
+import math
+import threading
+import time
+
+import orjson
+from cachetools import TLRUCache, TTLCache
+from django.conf import settings
+
+
+AUTH_CACHE_MAX = getattr(settings, 'AUTH_CACHE_MAX', 10_000)
+AUTH_CACHE_TTL_CAP = getattr(settings, 'AUTH_CACHE_TTL_CAP', 300)
+AUTH_CACHE_REDIS_URL = getattr(settings, 'AUTH_CACHE_REDIS_URL', None)
+
+if AUTH_CACHE_REDIS_URL:
+    import redis
+
+    _redis = redis.Redis.from_url(AUTH_CACHE_REDIS_URL)
+    _RedisError = redis.RedisError
+else:
+    _redis = None
+    _RedisError = ()
+
+
+def _claims_ttu(key, value, now):
+    return min(value['exp'], now + AUTH_CACHE_TTL_CAP)
+
+
+def _revoked_ttu(key, value, now):
+    return value
+
+
+_lock = threading.RLock()
+_claims = TLRUCache(maxsize=AUTH_CACHE_MAX, ttu=_claims_ttu, timer=time.time)
+# Keys of tokens seen once; only these are admitted into _claims on a hit
+_doorkeeper = TTLCache(
+    maxsize=AUTH_CACHE_MAX, ttl=AUTH_CACHE_TTL_CAP, timer=time.time)
+# Logged out tokens, kept until they would have expired anyway. Unbounded:
+# dropping an entry early would make a logged out token valid again.
+_revoked = TLRUCache(maxsize=math.inf, ttu=_revoked_ttu, timer=time.time)
+
+
+def make_key(token: str) -> bytes:
+    """Return the cache key for a raw access token."""
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def _redis_keys(key: bytes):
+    digest = key.hex()
+    return f'kc:tok:{digest}', f'kc:rev:{digest}'
+
+
+def _ttl(exp) -> int:
+    return int(min(exp - time.time(), AUTH_CACHE_TTL_CAP))
+
+
+def is_revoked(key: bytes) -> bool:
+    """
+    Whether the token was logged out. Revocations seen in Redis are
+    recorded by ``get``, so call this after a cache miss.
+    """
+    with _lock:
+        return key in _revoked
+
+
+def get(key: bytes):
+    """
+    Return the cached claims for ``key`` or None. With Redis enabled, every
+    lookup also checks the revocation marker so logouts made in other
+    processes are honored immediately.
+    """
+    with _lock:
+        claims = _claims.get(key)
+    if _redis is None:
+        return claims
+
+    claims_key, revoked_key = _redis_keys(key)
+    try:
+        if claims is not None:
+            raw_claims, revoked_until = None, _redis.get(revoked_key)
+        else:
+            raw_claims, revoked_until = _redis.mget(claims_key, revoked_key)
+    except _RedisError:
+        return claims
+    if revoked_until is not None:
+        with _lock:
+            _claims.pop(key, None)
+            _revoked[key] = float(revoked_until)
+        return None
+    if claims is not None or raw_claims is None:
+        return claims
+    claims = orjson.loads(raw_claims)
+    with _lock:
+        _claims[key] = claims
+    return claims
+
+
+def put(key: bytes, claims: dict) -> None:
+    """
+    Share verified ``claims`` through Redis and cache them in-process once
+    the token has been seen twice.
+    """
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, float)):
+        return
+    with _lock:
+        if key in _doorkeeper:
+            del _doorkeeper[key]
+            _claims[key] = claims
+        else:
+            _doorkeeper[key] = True
+
+    ttl = _ttl(exp)
+    if _redis is not None and ttl > 0:
+        claims_key, _ = _redis_keys(key)
+        try:
+            _redis.set(claims_key, orjson.dumps(claims), ex=ttl, nx=True)
+        except _RedisError:
+            pass
+
+
+def revoke(token: str, exp) -> None:
+    """Reject ``token`` in every process until its ``exp``."""
+    key = make_key(token)
+    with _lock:
+        _claims.pop(key, None)
+        if isinstance(exp, (int, float)):
+            _revoked[key] = exp
+
+    if _redis is not None:
+        claims_key, revoked_key = _redis_keys(key)
+        try:
+            pipe = _redis.pipeline()
+            pipe.delete(claims_key)
+            if isinstance(exp, (int, float)) and exp > time.time():
+                pipe.set(revoked_key, exp, ex=int(exp - time.time()) + 1)
+            pipe.execute()
+        except _RedisError:
+            pass
@@ -1,24 +1,201 @@
+import threading
+import time
+
+import jwt
+import orjson
+import requests
+from django.conf import settings
+from jwt.algorithms import RSAAlgorithm
+from keycloak.exceptions import (
+    KeycloakAuthenticationError,
+    KeycloakConnectionError,
+    KeycloakGetError,
+    KeycloakPostError,
+)
+from rest_framework import status
 from rest_framework.authentication import BaseAuthentication
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import APIException, AuthenticationFailed
 from . import kc_openID_services
+from .kc_http import session
+from . import _token_cache
 from drf_spectacular.extensions import OpenApiAuthenticationExtension
 from rest_framework.permissions import BasePermission
 
 
+_BEARER_PREFIX = 'Bearer '
+_BEARER_PREFIX_LEN = len(_BEARER_PREFIX)
+_UNPARSED = object()
+_MIN_TOKEN_LENGTH = 32
+_INVALID_TOKEN_MESSAGE = "Incorrect authentication credentials. Either the authentication token is not valid or expired."  # noqa
+_VERIFICATION_ERRORS = (
+    jwt.InvalidTokenError,
+    KeycloakAuthenticationError,
+    KeycloakGetError,
+    KeycloakPostError,
+)
+
+_REALM_URL = f"{settings.KEYCLOAK_SERVER_URL.rstrip('/')}/realms/{settings.KEYCLOAK_REALM}"  # noqa
+# Keycloak sets ``iss`` from its public hostname, which differs from
+# KEYCLOAK_SERVER_URL when the backend reaches Keycloak on an internal URL
+_ISSUER = getattr(settings, 'KEYCLOAK_ISSUER', None) or _REALM_URL
+_AUDIENCE = getattr(settings, 'KEYCLOAK_AUDIENCE', None)
+_DECODE_ALGORITHMS = ['RS256']
+_DECODE_OPTIONS = {
+    'verify_signature': True,
+    'verify_exp': True,
+    'verify_iss': True,
+    'verify_aud': _AUDIENCE is not None,
+    'require': ['exp', 'iss'],
+}
+
+# Snapshot of the realm signing keys, keyed by ``kid``. Readers never take
+# the lock; a refresh publishes a new dict with a single assignment.
+_JWKS = {'keys': {}, 'fetched': 0.0, 'attempted': 0.0}
+_JWKS_LOCK = threading.Lock()
+_JWKS_TTL = 300  # 5 minutes
+# Minimum time between two fetches, successful or not; unknown ``kid``s and
+# an unreachable Keycloak can't trigger a refetch more often than this
+_JWKS_MIN_REFRESH_INTERVAL = 10
+
+
+def _fetch_jwks():
+    """Fetch the realm's public RSA signing keys from Keycloak."""
+    certs_url = f"{_REALM_URL}/protocol/openid-connect/certs"
+    response = session.get(certs_url, timeout=5)
+    response.raise_for_status()
+    keys = orjson.loads(response.content).get('keys', [])
+    # Build the public key objects once instead of on every decode
+    signing_keys = {}
+    for jwk in keys:
+        if (jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig'
+                or 'kid' not in jwk):
+            continue
+        try:
+            signing_keys[jwk['kid']] = RSAAlgorithm.from_jwk(jwk)
+        except (jwt.InvalidKeyError, ValueError):
+            # A malformed key must not take the realm's other keys down
+            continue
+    return signing_keys
+
+
+def _get_signing_key(kid):
+    """
+    Return the public key for ``kid`` from the current snapshot. Raises
+    KeyError when no key for ``kid`` can be obtained.
+    """
+    jwks = _JWKS
+    key = jwks['keys'].get(kid)
+    if key is not None:
+        now = time.time()
+        if (now - jwks['fetched'] < _JWKS_TTL
+                or now - jwks['attempted'] < _JWKS_MIN_REFRESH_INTERVAL):
+            return key
+    return _refresh_and_get(kid)
+
+
+def _refresh_and_get(kid):
+    """
+    Refetch the keys when the snapshot is stale or ``kid`` is unknown
+    (key rotation) and return the public key for ``kid``. While Keycloak
+    can't be reached the previous keys keep being served.
+    """
+    global _JWKS
+    with _JWKS_LOCK:
+        # Another thread may have refreshed while we waited for the lock
+        jwks = _JWKS
+        now = time.time()
+        needs_refresh = (
+            now - jwks['fetched'] >= _JWKS_TTL or kid not in jwks['keys'])
+        backed_off = now - jwks['attempted'] < _JWKS_MIN_REFRESH_INTERVAL
+        if needs_refresh and not backed_off:
+            try:
+                keys = _fetch_jwks()
+                jwks = {'keys': keys, 'fetched': now, 'attempted': now}
+            except (requests.RequestException, ValueError):
+                jwks = dict(jwks, attempted=now)
+            _JWKS = jwks
+        return jwks['keys'][kid]
+
+
+def _decode_access_token(access_token, key):
+    """
+    Verify the token signature, expiry and issuer locally against the realm
+    key and return its claims. Only access tokens are accepted, not ID or
+    refresh tokens signed by the same realm.
+    """
+    claims = jwt.decode(
+        access_token,
+        key,
+        algorithms=_DECODE_ALGORITHMS,
+        audience=_AUDIENCE,
+        issuer=_ISSUER,
+        options=_DECODE_OPTIONS,
+    )
+    if claims.get('typ') != 'Bearer':
+        raise jwt.InvalidTokenError("Not an access token")
+    return claims
+
+
+def parse_bearer_token(auth_header):
+    """Return the token of a ``Bearer`` Authorization header or None."""
+    if not auth_header or not auth_header.startswith(_BEARER_PREFIX):
+        return None
+    return auth_header[_BEARER_PREFIX_LEN:].strip()
+
+
+class KeycloakUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Keycloak is unavailable, try again later.'
+    default_code = 'keycloak_unavailable'
+
+
+def _verify_access_token(access_token):
+    """
+    Return the claims of an access token, verified locally or, when the
+    realm key for it can't be obtained, by Keycloak's userinfo endpoint.
+    Tokens that fail local verification are rejected. Raises
+    KeycloakUnavailable when neither way can reach Keycloak.
+    """
+    kid = jwt.get_unverified_header(access_token).get('kid')
+    try:
+        key = _get_signing_key(kid)
+    except KeyError:
+        # Unknown ``kid`` even after a refresh, or the keys can't be fetched
+        try:
+            return kc_openID_services.get_user_info(access_token)
+        except KeycloakConnectionError:
+            raise KeycloakUnavailable() from None
+    return _decode_access_token(access_token, key)
+
+
 class KeycloakAuthentication(BaseAuthentication):
     def authenticate(self, request):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
+        # Already parsed by KeycloakBearerMiddleware when it is installed
+        access_token = getattr(request, '_bearer_token', _UNPARSED)
+        if access_token is _UNPARSED:
+            access_token = parse_bearer_token(
+                request.META.get('HTTP_AUTHORIZATION'))
+        if not access_token:
             return None
-        access_token = auth_header.split()[1]
-        try:
-            userinfo = kc_openID_services.get_user_info(access_token)
-            user = KeycloakUser(userinfo)
-            return (user, None)
-        except:
-            raise AuthenticationFailed(
-                "Incorrect authentication credentials. Either the authentication token is not valid or expired."
-            )
+        # Cheap reject of noise that can't be a JWT (header.payload.signature)
+        if (len(access_token) < _MIN_TOKEN_LENGTH
+                or access_token.count('.') != 2):
+            raise AuthenticationFailed(_INVALID_TOKEN_MESSAGE)
+
+        cache_key = _token_cache.make_key(access_token)
+        userinfo = _token_cache.get(cache_key)
+        if userinfo is None:
+            # Revoked tokens are never served from the cache
+            if _token_cache.is_revoked(cache_key):
+                raise AuthenticationFailed(_INVALID_TOKEN_MESSAGE)
+            try:
+                userinfo = _verify_access_token(access_token)
+            except _VERIFICATION_ERRORS:
+                raise AuthenticationFailed(_INVALID_TOKEN_MESSAGE) from None
+            _token_cache.put(cache_key, userinfo)
+
+        request._keycloak_claims = userinfo
+        return (KeycloakUser(userinfo), access_token)
 
 
 class KeycloakAuthenticationScheme(OpenApiAuthenticationExtension):
@@ -35,28 +212,23 @@ class KeycloakAuthenticationScheme(OpenApiAuthenticationExtension):
 
 class IsKeycloakAuthenticated(BasePermission):
     def has_permission(self, request, view):
-        # Perform token validation and permissions checks
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return False
-
-        access_token = auth_header.split()[1]
-
-        try:
-            userinfo = kc_openID_services.get_user_info(access_token)
-            # Add additional permission checks if needed
-            return True
-        except:
-            return False
+        # Set once KeycloakAuthentication has verified the token
+        return getattr(request, '_keycloak_claims', None) is not None
 
 
 class KeycloakUser:
+    __slots__ = ('userinfo',)
+    is_authenticated = True
+
     def __init__(self, userinfo):
         self.userinfo = userinfo
 
-    @property
-    def is_authenticated(self):
-        return True
-
     def __getattr__(self, item):
-        return self.userinfo.get(item, None)
+        # Private and dunder lookups (and an unset slot) must not fall
+        # through to the claims
+        if item.startswith('_') or item == 'userinfo':
+            raise AttributeError(item)
+        return self.userinfo.get(item)
+
+    def __getitem__(self, item):
+        return self.userinfo[item]
@@ -0,0 +1,20 @@
+"""
+Shared, pooled HTTP session for the app's own calls to Keycloak.
+
+Reusing one session keeps connections to Keycloak alive between requests,
+so only the first call pays for the TCP and TLS handshakes.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+session = requests.Session()
+session.auth = lambda r: r  # don't let requests add auth headers (.netrc)
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
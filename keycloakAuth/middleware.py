@@ -0,0 +1,15 @@
+from .authentication import parse_bearer_token
+
+
+class KeycloakBearerMiddleware:
+    """
+    Parse the bearer token out of the Authorization header once per request
+    so authentication doesn't have to re-read the headers.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._bearer_token = parse_bearer_token(
+            request.META.get('HTTP_AUTHORIZATION'))
+        return self.get_response(request)
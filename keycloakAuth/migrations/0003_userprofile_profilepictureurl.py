@@ -0,0 +1,31 @@
+# Generated by Django 5.0.8 on 2026-10-15 12:00
+
+from django.db import migrations, models
+
+
+def populate_profile_picture_url(apps, schema_editor):
+    UserProfile = apps.get_model('keycloakAuth', 'UserProfile')
+    user_profiles = UserProfile.objects.exclude(
+        profilePicture='').exclude(profilePicture=None)
+    for user_profile in user_profiles:
+        user_profile.profilePictureUrl = user_profile.profilePicture.url
+        user_profile.save(update_fields=['profilePictureUrl'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keycloakAuth', '0002_alter_userprofile_createddate_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='profilePictureUrl',
+            field=models.CharField(
+                blank=True, db_column='profilePictureUrl', default='',
+                editable=False, max_length=512),
+        ),
+        migrations.RunPython(
+            populate_profile_picture_url, migrations.RunPython.noop),
+    ]
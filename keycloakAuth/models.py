@@ -33,3 +33,20 @@ class UserProfile(models.Model):
         null=True,
         db_column="updatedDate"
         )
+    # Denormalized profilePicture.url so reads don't hit the storage backend
+    profilePictureUrl = models.CharField(
+        max_length=512,
+        blank=True,
+        default='',
+        editable=False,
+        db_column="profilePictureUrl"
+        )
+
+    def save(self, *args, **kwargs):
+        # The file is only stored (and gets its final name) during save
+        super().save(*args, **kwargs)
+        url = self.profilePicture.url if self.profilePicture else ''
+        if url != self.profilePictureUrl:
+            self.profilePictureUrl = url
+            UserProfile.objects.filter(pk=self.pk).update(
+                profilePictureUrl=url)
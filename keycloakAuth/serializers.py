@@ -1,6 +1,7 @@
+from django.core.cache import cache
 from rest_framework import serializers
 from .models import UserProfile
-from typing import Union
+from typing import Dict, Union
 
 
 class TokenSerializer(serializers.Serializer):
@@ -23,6 +24,63 @@ class RefreshTokenRequestSerializer(serializers.Serializer):
     refresh_token = serializers.CharField()
 
 
+PROFILE_PICTURE_CACHE_TTL = 60  # seconds
+
+
+def _profile_picture_cache_key(sub: str) -> str:
+    return f'kc:pp:{sub}'
+
+
+def forget_profile_picture(sub: str) -> None:
+    """Drop the cached profile picture url of a user"""
+    cache.delete(_profile_picture_cache_key(sub))
+
+
+def load_profile_pictures(subs, profile_map: Dict[str, str]) -> None:
+    """
+    Resolve the profile picture urls of ``subs`` missing from
+    ``profile_map`` with at most one cache round-trip and one query.
+    Users without a picture are mapped to an empty string.
+    """
+    missing = {sub for sub in subs if sub not in profile_map}
+    if not missing:
+        return
+    cached = cache.get_many(
+        [_profile_picture_cache_key(sub) for sub in missing])
+    for sub in list(missing):
+        url = cached.get(_profile_picture_cache_key(sub))
+        if url is not None:
+            profile_map[sub] = url
+            missing.discard(sub)
+    if not missing:
+        return
+
+    resolved = dict.fromkeys(missing, '')
+    resolved.update(UserProfile.objects.filter(
+        uuid__in=missing).values_list('uuid', 'profilePictureUrl'))
+    profile_map.update(resolved)
+    cache.set_many(
+        {_profile_picture_cache_key(sub): url
+         for sub, url in resolved.items()},
+        PROFILE_PICTURE_CACHE_TTL)
+
+
+def get_profile_picture_url(sub: str) -> Union[str, None]:
+    """Return the profile picture url of a single user, if any"""
+    profile_map = {}
+    load_profile_pictures([sub], profile_map)
+    return profile_map[sub] or None
+
+
+class UserInfoListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Resolve all profile pictures up front instead of one query per user
+        load_profile_pictures(
+            [item['sub'] for item in data],
+            self.context.setdefault('profile_map', {}))
+        return super().to_representation(data)
+
+
 class UserInfoSerializer(serializers.Serializer):
     sub = serializers.CharField()  # ID of the user
     given_name = serializers.CharField()
@@ -33,15 +91,13 @@ class UserInfoSerializer(serializers.Serializer):
     phone_number = serializers.CharField(required=False, allow_blank=True)
     profile_picture = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = UserInfoListSerializer
+
     def get_profile_picture(self, obj) -> Union[str, None]:
-        try:
-            user_profile = UserProfile.objects.get(uuid=obj['sub'])
-            if user_profile.profilePicture and hasattr(user_profile.profilePicture, 'url'):
-                return user_profile.profilePicture.url
-            else:
-                return None
-        except UserProfile.DoesNotExist:
-            return None
+        profile_map = self.context.setdefault('profile_map', {})
+        load_profile_pictures([obj['sub']], profile_map)
+        return profile_map[obj['sub']] or None
 
     def to_representation(self, obj):
         # Use the default serialization
@@ -1,3 +1,456 @@
-from django.test import TestCase
+import importlib
+import json
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import requests
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.apps import apps
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from jwt.algorithms import RSAAlgorithm
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from . import _token_cache
+from . import authentication
+from .authentication import (
+    IsKeycloakAuthenticated,
+    KeycloakAuthentication,
+    KeycloakUser,
+)
+from . import middleware as middleware_module
+from .middleware import KeycloakBearerMiddleware
+from .models import UserProfile
+from .serializers import UserInfoSerializer
+from .views import LogOutView, UserInfoView
+
+try:
+    import fakeredis
+    import redis
+except ImportError:  # pragma: no cover
+    fakeredis = None
+
+
+def _make_key_pair():
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048)
+    return private_key, private_key.public_key()
+
+
+PRIVATE_KEY, PUBLIC_KEY = _make_key_pair()
+OTHER_PRIVATE_KEY, OTHER_PUBLIC_KEY = _make_key_pair()
+
+
+def make_token(kid='k1', private_key=PRIVATE_KEY, expires_in=300, **claims):
+    """Sign a realm access token, overriding any claim with ``claims``."""
+    payload = {
+        'sub': 'user-1',
+        'email': 'user@example.com',
+        'preferred_username': 'user',
+        'given_name': 'Test',
+        'family_name': 'User',
+        'typ': 'Bearer',
+        'iss': authentication._ISSUER,
+        'exp': int(time.time()) + expires_in,
+    }
+    payload.update(claims)
+    payload = {k: v for k, v in payload.items() if v is not None}
+    return jwt.encode(
+        payload, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+def reset_caches():
+    _token_cache._claims.clear()
+    _token_cache._doorkeeper.clear()
+    _token_cache._revoked.clear()
+    authentication._JWKS = {'keys': {}, 'fetched': 0.0, 'attempted': 0.0}
+    cache.clear()
+
+
+class KeycloakTestCase(TestCase):
+    """Stubs Keycloak: realm keys come from ``self.jwks``."""
+
+    def setUp(self):
+        reset_caches()
+        self.addCleanup(reset_caches)
+        self.jwks = {'k1': PUBLIC_KEY}
+        self.fetch_jwks = self._patch(
+            authentication, '_fetch_jwks',
+            side_effect=lambda: dict(self.jwks))
+        self.get_user_info = self._patch(
+            authentication.kc_openID_services, 'get_user_info', create=True,
+            side_effect=authentication.KeycloakAuthenticationError('', 401))
+        self._patch(authentication, '_AUDIENCE', new=None)
+        patcher = mock.patch.dict(
+            authentication._DECODE_OPTIONS, verify_aud=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.factory = APIRequestFactory()
+
+    def _patch(self, target, attribute, **kwargs):
+        patcher = mock.patch.object(target, attribute, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def authenticate(self, token):
+        request = Request(
+            self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+        return KeycloakAuthentication().authenticate(request)
+
+
+class LocalVerificationTests(KeycloakTestCase):
+
+    def test_valid_token_is_verified_locally(self):
+        user, auth = self.authenticate(make_token())
+        self.assertEqual(user.sub, 'user-1')
+        self.assertEqual(user['email'], 'user@example.com')
+        self.assertTrue(user.is_authenticated)
+        self.get_user_info.assert_not_called()
+
+    def test_rejected_tokens_never_reach_userinfo(self):
+        cases = {
+            'expired': make_token(expires_in=-10),
+            'bad signature': make_token(private_key=OTHER_PRIVATE_KEY),
+            'id token': make_token(typ='ID'),
+            'refresh token': make_token(typ='Refresh'),
+            'other issuer': make_token(iss='https://evil.example/realms/r'),
+            'missing issuer': make_token(iss=None),
+            'noise': 'a' * 20 + '.' + 'b' * 20 + '.c',
+        }
+        for name, token in cases.items():
+            with self.subTest(name):
+                with self.assertRaises(AuthenticationFailed):
+                    self.authenticate(token)
+        self.get_user_info.assert_not_called()
+
+    def test_audience_is_enforced_when_configured(self):
+        self._patch(authentication, '_AUDIENCE', new='myclient')
+        authentication._DECODE_OPTIONS['verify_aud'] = True
+        user, _ = self.authenticate(make_token(aud='myclient'))
+        self.assertEqual(user.sub, 'user-1')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(make_token(aud='other'))
+        self.get_user_info.assert_not_called()
+
+    def test_configured_issuer_replaces_the_server_url(self):
+        self._patch(
+            authentication, '_ISSUER', new='https://auth.example/realms/r')
+        user, _ = self.authenticate(make_token())
+        self.assertEqual(user.sub, 'user-1')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(make_token(iss=authentication._REALM_URL))
+
+    def test_malformed_header_is_rejected_before_parsing(self):
+        with mock.patch.object(jwt, 'get_unverified_header') as header:
+            for token in ('short', 'x' * 40, 'a.b'):
+                with self.assertRaises(AuthenticationFailed):
+                    self.authenticate(token)
+        header.assert_not_called()
+
+    def test_non_bearer_header_is_ignored(self):
+        request = Request(self.factory.get('/', HTTP_AUTHORIZATION='Basic x'))
+        self.assertIsNone(KeycloakAuthentication().authenticate(request))
+
+    def test_unknown_kid_falls_back_to_userinfo(self):
+        self.get_user_info.side_effect = None
+        self.get_user_info.return_value = {'sub': 'user-2'}
+        user, _ = self.authenticate(make_token(kid='unknown'))
+        self.assertEqual(user.sub, 'user-2')
+        self.get_user_info.assert_called_once()
+
+    def test_unreachable_keycloak_is_service_unavailable(self):
+        self.fetch_jwks.side_effect = requests.ConnectionError('down')
+        self.get_user_info.side_effect = (
+            authentication.KeycloakConnectionError('down'))
+        request = self.factory.get(
+            '/', HTTP_AUTHORIZATION=f'Bearer {make_token()}')
+        response = UserInfoView.as_view()(request)
+        self.assertEqual(response.status_code, 503)
+        self.get_user_info.assert_called_once()
+
+    def test_rotated_key_is_picked_up(self):
+        authentication._get_signing_key('k1')
+        authentication._JWKS = dict(
+            authentication._JWKS, attempted=time.time() - 60)
+        self.jwks = {'k2': OTHER_PUBLIC_KEY}
+        user, _ = self.authenticate(
+            make_token(kid='k2', private_key=OTHER_PRIVATE_KEY))
+        self.assertEqual(user.sub, 'user-1')
+        self.assertEqual(self.fetch_jwks.call_count, 2)
+
+
+class TokenCacheTests(KeycloakTestCase):
+
+    def test_token_is_cached_on_second_sighting(self):
+        token = make_token()
+        key = _token_cache.make_key(token)
+        self.authenticate(token)
+        self.assertIsNone(_token_cache.get(key))
+        self.authenticate(token)
+        self.assertEqual(_token_cache.get(key)['sub'], 'user-1')
+        with mock.patch.object(
+                authentication, '_verify_access_token') as verify:
+            self.authenticate(token)
+        verify.assert_not_called()
+
+    def test_claims_ttl_is_capped(self):
+        now = time.time()
+        self.assertEqual(
+            _token_cache._claims_ttu(b'k', {'exp': now + 10_000}, now),
+            now + _token_cache.AUTH_CACHE_TTL_CAP)
+        self.assertEqual(
+            _token_cache._claims_ttu(b'k', {'exp': now + 5}, now), now + 5)
+
+    def test_userinfo_claims_without_exp_are_not_cached(self):
+        key = _token_cache.make_key('token')
+        _token_cache.put(key, {'sub': 'user-1'})
+        _token_cache.put(key, {'sub': 'user-1'})
+        self.assertIsNone(_token_cache.get(key))
+
+    def test_revoked_token_is_rejected(self):
+        token = make_token()
+        user, _ = self.authenticate(token)
+        self.authenticate(token)
+        _token_cache.revoke(token, user.exp)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_revocations_are_not_evicted_by_other_logouts(self):
+        token = make_token()
+        _token_cache.revoke(token, time.time() + 300)
+        for i in range(2000):
+            _token_cache.revoke(f'other-{i}', time.time() + 300)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_revocation_expires_with_the_token(self):
+        _token_cache.revoke('token', time.time() - 1)
+        self.assertFalse(
+            _token_cache.is_revoked(_token_cache.make_key('token')))
+
+    def test_logout_revokes_the_access_token(self):
+        self._patch(
+            authentication.kc_openID_services, 'logout', create=True)
+        token = make_token()
+        request = self.factory.post(
+            '/', {'refresh_token': 'refresh'}, format='json',
+            HTTP_AUTHORIZATION=f'Bearer {token}')
+        response = LogOutView.as_view()(request)
+        self.assertEqual(response.status_code, 204)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+
+class RedisTokenCacheTests(KeycloakTestCase):
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest('fakeredis is not installed')
+        super().setUp()
+        self.redis = fakeredis.FakeRedis()
+        self._patch(_token_cache, '_redis', new=self.redis)
+        self._patch(_token_cache, '_RedisError', new=redis.RedisError)
+
+    def clear_local_cache(self):
+        """Simulate another worker: same Redis, empty in-process cache."""
+        _token_cache._claims.clear()
+        _token_cache._doorkeeper.clear()
+        _token_cache._revoked.clear()
+
+    def test_verified_claims_are_shared_between_processes(self):
+        token = make_token()
+        self.authenticate(token)
+        self.clear_local_cache()
+        with mock.patch.object(
+                authentication, '_verify_access_token') as verify:
+            user, _ = self.authenticate(token)
+        verify.assert_not_called()
+        self.assertEqual(user.sub, 'user-1')
+
+    def test_logout_in_another_process_is_honored_on_local_hit(self):
+        token = make_token()
+        user, _ = self.authenticate(token)
+        self.authenticate(token)
+        self.assertIsNotNone(_token_cache.get(_token_cache.make_key(token)))
+        # Revoke from "another process": only the Redis marker is shared
+        key = _token_cache.make_key(token)
+        self.redis.set(_token_cache._redis_keys(key)[1], user.exp)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_redis_errors_fall_back_to_local_cache(self):
+        token = make_token()
+        self.authenticate(token)
+        self.authenticate(token)
+        with mock.patch.object(
+                self.redis, 'get', side_effect=redis.ConnectionError):
+            user, _ = self.authenticate(token)
+        self.assertEqual(user.sub, 'user-1')
+
+
+class JWKSTests(KeycloakTestCase):
+
+    def test_concurrent_misses_fetch_once(self):
+        def slow_fetch():
+            time.sleep(0.05)
+            return dict(self.jwks)
+        self.fetch_jwks.side_effect = slow_fetch
+        threads = [
+            threading.Thread(target=authentication._get_signing_key,
+                             args=('k1',))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetch_jwks.call_count, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        authentication._get_signing_key('k1')
+        for _ in range(5):
+            with self.assertRaises(KeyError):
+                authentication._get_signing_key('unknown')
+        self.assertEqual(self.fetch_jwks.call_count, 1)
+
+    def test_stale_keys_are_served_while_keycloak_is_down(self):
+        authentication._get_signing_key('k1')
+        authentication._JWKS = dict(
+            authentication._JWKS,
+            fetched=time.time() - 600, attempted=time.time() - 600)
+        self.fetch_jwks.side_effect = requests.ConnectionError('down')
+        for _ in range(5):
+            self.assertIs(authentication._get_signing_key('k1'), PUBLIC_KEY)
+        self.assertEqual(self.fetch_jwks.call_count, 2)
+
+
+class FetchJWKSTests(TestCase):
+
+    def test_fetch_keeps_only_well_formed_rsa_signing_keys(self):
+        jwk = json.loads(RSAAlgorithm.to_jwk(PUBLIC_KEY))
+        keys = [
+            dict(jwk, kid='sig', use='sig'),
+            dict(jwk, kid='enc', use='enc'),
+            {'kid': 'hmac', 'kty': 'oct', 'k': 'c2VjcmV0'},
+            {'kid': 'malformed', 'kty': 'RSA', 'use': 'sig'},
+            {k: v for k, v in jwk.items() if k != 'kid'},
+        ]
+        response = mock.Mock(content=json.dumps({'keys': keys}).encode())
+        with mock.patch.object(
+                authentication.session, 'get', return_value=response) as get:
+            jwks = authentication._fetch_jwks()
+        self.assertEqual(list(jwks), ['sig'])
+        self.assertEqual(
+            jwks['sig'].public_numbers(), PUBLIC_KEY.public_numbers())
+        self.assertTrue(get.call_args.args[0].startswith(
+            authentication._REALM_URL))
+
+
+class MiddlewareAndPermissionTests(KeycloakTestCase):
+
+    def get_user_info_view(self, token, middleware=True):
+        request = self.factory.get(
+            '/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        view = UserInfoView.as_view()
+        if middleware:
+            return KeycloakBearerMiddleware(view)(request)
+        return view(request)
+
+    def test_user_info_with_and_without_middleware(self):
+        for middleware in (True, False):
+            with self.subTest(middleware=middleware):
+                response = self.get_user_info_view(make_token(), middleware)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['sub'], 'user-1')
+                self.assertIsNone(response.data['profile_picture'])
+
+    def test_middleware_parses_the_header_once(self):
+        parse = mock.Mock(wraps=authentication.parse_bearer_token)
+        self._patch(authentication, 'parse_bearer_token', new=parse)
+        self._patch(middleware_module, 'parse_bearer_token', new=parse)
+        response = self.get_user_info_view(make_token())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_invalid_token_is_denied(self):
+        response = self.get_user_info_view(make_token(typ='ID'))
+        self.assertIn(response.status_code, (401, 403))
+
+    def test_permission_requires_keycloak_claims(self):
+        permission = IsKeycloakAuthenticated()
+        request = Request(self.factory.get('/'))
+        request.user = KeycloakUser({'sub': 'user-1'})
+        self.assertFalse(permission.has_permission(request, None))
+        request._keycloak_claims = {'sub': 'user-1'}
+        self.assertTrue(permission.has_permission(request, None))
+
+
+class KeycloakUserTests(TestCase):
+
+    def test_claims_are_exposed_as_attributes_and_items(self):
+        user = KeycloakUser({'sub': 'user-1'})
+        self.assertEqual(user.sub, 'user-1')
+        self.assertEqual(user['sub'], 'user-1')
+        self.assertIsNone(user.is_staff)
+
+    def test_private_attributes_are_not_claims(self):
+        user = KeycloakUser({'_meta': 'claim'})
+        self.assertFalse(hasattr(user, '_meta'))
+        self.assertFalse(hasattr(user, '__html__'))
+
+
+class UserProfilePictureUrlTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_save_stores_the_picture_url(self):
+        profile = UserProfile.objects.create(
+            uuid='user-1', email='user@example.com',
+            profilePicture=SimpleUploadedFile('avatar.png', b'png'))
+        profile.refresh_from_db()
+        self.assertTrue(profile.profilePictureUrl)
+        self.assertEqual(profile.profilePictureUrl, profile.profilePicture.url)
+
+        profile.profilePicture = None
+        profile.save()
+        profile.refresh_from_db()
+        self.assertEqual(profile.profilePictureUrl, '')
+
+    def test_lookup_reads_the_stored_url_in_one_query(self):
+        UserProfile.objects.create(
+            uuid='user-1', email='user@example.com',
+            profilePicture=SimpleUploadedFile('avatar.png', b'png'))
+        users = [
+            {'sub': f'user-{i}', 'given_name': 'a', 'family_name': 'b',
+             'preferred_username': 'c', 'email': 'a@example.com'}
+            for i in range(1, 6)
+        ]
+        with self.assertNumQueries(1):
+            data = UserInfoSerializer(users, many=True).data
+        self.assertTrue(data[0]['profile_picture'])
+        self.assertIsNone(data[1]['profile_picture'])
+
+    def test_migration_backfills_existing_rows(self):
+        migration = importlib.import_module(
+            apps.get_app_config('keycloakAuth').module.__name__
+            + '.migrations.0003_userprofile_profilepictureurl')
+        UserProfile.objects.create(uuid='user-1', email='user@example.com')
+        UserProfile.objects.filter(uuid='user-1').update(
+            profilePicture='uploads/user_profile_picture/a.png',
+            profilePictureUrl='')
+        migration.populate_profile_picture_url(apps, None)
+        profile = UserProfile.objects.get(uuid='user-1')
+        self.assertEqual(profile.profilePictureUrl, profile.profilePicture.url)